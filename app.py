@@ -1,17 +1,201 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
+import functools
+from math import radians, cos, sin, asin, sqrt
 import re
 import os
 import random
-from typing import Dict, List, Optional
+import orjson
+from typing import Dict, Iterator, List, Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
 import time
 
+try:
+    import redis
+except ImportError:  # Redis is optional; sessions fall back to process memory
+    redis = None
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson for faster jsonify/get_json"""
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
+# Location extraction patterns, tried in order (compiled once at import)
+LOCATION_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE) for pattern in [
+        r"(?:at|near|in|around|by|close to|next to)\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
+        r"park\s+(?:at|near|in|around|by|close to|next to)\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
+        r"parking\s+(?:at|near|in|around|by|close to|next to)\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
+        r"(?:where|how|can)\s+.*?(?:at|near|in|around|by)\s+([^?.,!]+?)(?:\s*[?.,!]|$)",
+        r"going\s+to\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
+        r"visiting\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
+        r"spots?\s+(?:in|at|near)\s+([^?.,!]+?)(?:\s*[?.,!]|$)",
+        r"spaces?\s+(?:in|at|near)\s+([^?.,!]+?)(?:\s*[?.,!]|$)"
+    ]
+]
+
+# Captured "locations" that are really just filler words
+LOCATION_STOPWORDS = frozenset({'there', 'here', 'it', 'this', 'that', 'a', 'the'})
+
+@functools.lru_cache(maxsize=1024)
+def extract_location(user_input: str) -> Optional[str]:
+    """Extract location from user query using improved patterns (memoized per input)"""
+    for pattern in LOCATION_PATTERNS:
+        match = pattern.search(user_input)
+        if match:
+            location = match.group(1).strip()
+            if location.lower() not in LOCATION_STOPWORDS:
+                return location
+    
+    return None
+
+# Relevance filter for HERE result titles (substring match)
+PARKING_TITLE_RE = re.compile(r"park|garage|car|space|charging")
+
+# Parking type by title words, first match wins; anything else is a 'parking-lot'
+TITLE_TOKEN_RE = re.compile(r"[a-z]+")
+TYPE_MAP = [
+    ('parking-garage', frozenset({'garage', 'garages', 'multi', 'story', 'storey', 'multistory', 'multistorey'})),
+    ('on-street-parking', frozenset({'street', 'streets', 'streetside', 'road', 'roads', 'roadside', 'meter', 'meters', 'metered'})),
+    ('ev-charging', frozenset({'electric', 'ev', 'charging'}))
+]
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries expire after a fixed TTL"""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """Atomically return the live value for key (inserting factory() if missing) and refresh its TTL"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._data.get(key)
+            value = entry[1] if entry is not None and entry[0] >= now else factory()
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+
+def connect_redis(redis_url: Optional[str]):
+    """Create the shared Redis client, or None when Redis is not configured or installed"""
+    if not redis_url:
+        return None
+    if redis is None:
+        print("REDIS_URL is set but the redis package is not installed; using in-memory caches and sessions")
+        return None
+    
+    # Short timeouts so a stalled Redis can't pin request threads
+    return redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+        redis_url, socket_timeout=2, socket_connect_timeout=2
+    ))
+
+class SessionStore:
+    """Per-session conversation state, kept in Redis when a client is given"""
+    def __init__(self, redis_client=None, ttl: int = 3600, max_history: int = 10, max_local_sessions: int = 10000):
+        self.ttl = ttl
+        self.max_history = max_history
+        self.redis = redis_client
+        # In-memory fallback: idle sessions expire after ttl, like the Redis keys
+        self._local = TTLCache(maxsize=max_local_sessions, ttl=ttl)
+
+    def _local_session(self, session_id: str) -> Dict:
+        # Every access refreshes the TTL, giving the same sliding expiry as Redis EXPIRE
+        return self._local.get_or_create(session_id, self._new_local_session)
+
+    def _new_local_session(self) -> Dict:
+        return {'history': deque(maxlen=self.max_history), 'last_parking_search': None}
+
+    def get_history(self, session_id: str) -> List[Dict]:
+        """Return conversation entries oldest first"""
+        if self.redis is None:
+            return list(self._local_session(session_id)['history'])
+        
+        # Redis failures degrade to a fresh conversation rather than failing the request
+        try:
+            entries = self.redis.lrange(f"session:{session_id}:history", 0, -1)
+        except redis.RedisError as e:
+            print(f"Session store error: {e}")
+            return []
+        return [orjson.loads(entry) for entry in reversed(entries)]
+
+    def add_history(self, session_id: str, user_input: str, assistant: str) -> None:
+        entry = {'user': user_input, 'assistant': assistant}
+        if self.redis is None:
+            self._local_session(session_id)['history'].append(entry)
+            return
+        
+        history_key = f"session:{session_id}:history"
+        pipe = self.redis.pipeline()
+        pipe.lpush(history_key, orjson.dumps(entry))
+        pipe.ltrim(history_key, 0, self.max_history - 1)
+        pipe.expire(history_key, self.ttl)
+        pipe.expire(f"session:{session_id}:last_search", self.ttl)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Session store error: {e}")
+
+    def get_last_search(self, session_id: str) -> Optional[Dict]:
+        if self.redis is None:
+            return self._local_session(session_id)['last_parking_search']
+        
+        try:
+            data = self.redis.get(f"session:{session_id}:last_search")
+        except redis.RedisError as e:
+            print(f"Session store error: {e}")
+            return None
+        return orjson.loads(data) if data else None
+
+    def set_last_search(self, session_id: str, search: Dict) -> None:
+        if self.redis is None:
+            self._local_session(session_id)['last_parking_search'] = search
+            return
+        
+        pipe = self.redis.pipeline()
+        pipe.set(f"session:{session_id}:last_search", orjson.dumps(search), ex=self.ttl)
+        pipe.expire(f"session:{session_id}:history", self.ttl)
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"Session store error: {e}")
+
 class Parksy:
     def __init__(self):
         # Get API keys from environment variables
@@ -23,8 +207,36 @@ class Parksy:
         self.here_parking_url = "https://discover.search.hereapi.com/v1/discover"
         self.openrouter_url = "https://openrouter.ai/api/v1/chat/completions"
         
-        # Conversation sessions (in production, use Redis or database)
-        self.conversations = {}
+        # Shared HTTP session so HERE/OpenRouter connections are kept alive and reused
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=50,
+            max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
+        
+        # Long-lived pool for fanning out HERE queries, sized to the connection pool
+        self.executor = ThreadPoolExecutor(max_workers=50, thread_name_prefix='parksy-here')
+        
+        # Shared Redis client (None without REDIS_URL) for sessions and the geocode look-aside
+        self.redis = connect_redis(os.getenv('REDIS_URL'))
+        
+        # Geocoding results keyed by normalized location string (24h TTL)
+        self.geocode_cache = TTLCache(maxsize=5000, ttl=86400)
+        
+        # Top parking results keyed by a ~110m coordinate grid cell (5min TTL)
+        self.parking_cache = TTLCache(maxsize=2000, ttl=300)
+        
+        # Mock fill-in spots per city, so repeat searches see stable numbers (10min TTL)
+        self.mock_cache = TTLCache(maxsize=500, ttl=600)
+        
+        # In-flight parking lookups so concurrent identical searches share one pipeline
+        self._inflight: Dict[str, Future] = {}
+        self._inflight_lock = threading.Lock()
+        
+        # Conversation sessions (Redis when REDIS_URL is set, otherwise in memory)
+        self.sessions = SessionStore(self.redis)
         
         # Enhanced system prompt for Parksy
         self.system_prompt = """You are Parksy, a friendly AI parking assistant who talks like a real person. You're knowledgeable, conversational, and genuinely want to help people with their parking struggles.
@@ -52,6 +264,23 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
 
     def geocode_location(self, location: str) -> Optional[Dict]:
         """Convert location string to coordinates using HERE Geocoding API"""
+        cache_key = ' '.join(location.lower().split())
+        cached = self.geocode_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Shared look-aside cache so every worker benefits from each geocode
+        shared = self.redis
+        if shared is not None:
+            try:
+                data = shared.get(f"geocode:{cache_key}")
+                if data:
+                    result = orjson.loads(data)
+                    self.geocode_cache.set(cache_key, result)
+                    return result
+            except Exception as e:
+                print(f"Geocode cache error: {e}")
+        
         try:
             params = {
                 'q': location,
@@ -59,19 +288,26 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
                 'limit': 1
             }
             
-            response = requests.get(self.here_geocoding_url, params=params, timeout=10)
+            response = self.session.get(self.here_geocoding_url, params=params, timeout=10)
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             if data.get('items'):
                 item = data['items'][0]
-                return {
+                result = {
                     'lat': item['position']['lat'],
                     'lng': item['position']['lng'],
                     'address': item['address']['label'],
                     'city': item['address'].get('city', ''),
                     'district': item['address'].get('district', '')
                 }
+                self.geocode_cache.set(cache_key, result)
+                if shared is not None:
+                    try:
+                        shared.setex(f"geocode:{cache_key}", 86400, orjson.dumps(result))
+                    except Exception as e:
+                        print(f"Geocode cache error: {e}")
+                return result
             return None
             
         except Exception as e:
@@ -80,7 +316,13 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
 
     def search_parking(self, lat: float, lng: float, radius: int = 1500) -> List[Dict]:
         """Enhanced parking search with multiple queries to get 10+ results"""
+        cache_key = f"park:{round(lat, 3)}:{round(lng, 3)}:{radius}"
+        cached = self.parking_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+        
         all_spots = []
+        seen_keys = set()
         
         # Multiple search queries for comprehensive results
         search_queries = [
@@ -91,63 +333,69 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             'parking lot'
         ]
         
-        for query in search_queries:
+        futures = {
+            self.executor.submit(self._fetch_parking, {'q': query, 'limit': 20}, lat, lng, 15): query
+            for query in search_queries
+        }
+        for future in futures:
             try:
-                params = {
-                    'at': f"{lat},{lng}",
-                    'limit': 20,
-                    'q': query,
-                    'apikey': self.here_api_key
-                }
-                
-                response = requests.get(self.here_parking_url, params=params, timeout=15)
-                response.raise_for_status()
-                
-                data = response.json()
-                
-                if 'items' in data:
-                    for spot in data['items']:
-                        spot_data = self._process_parking_spot(spot, lat, lng)
-                        if spot_data and not self._is_duplicate(spot_data, all_spots):
-                            all_spots.append(spot_data)
-                            
+                self._merge_spots(future.result(), lat, lng, all_spots, seen_keys)
             except Exception as e:
-                print(f"Search query '{query}' error: {e}")
+                print(f"Search query '{futures[future]}' error: {e}")
                 continue
         
         # Category-based search as backup
         if len(all_spots) < 5:
             category_ids = ['700-7600-0322', '700-7600-0323', '700-7600-0000']
-            for cat_id in category_ids:
+            futures = [
+                self.executor.submit(self._fetch_parking, {'categories': cat_id, 'limit': 15}, lat, lng, 10)
+                for cat_id in category_ids
+            ]
+            for future in futures:
                 try:
-                    params = {
-                        'at': f"{lat},{lng}",
-                        'categories': cat_id,
-                        'limit': 15,
-                        'apikey': self.here_api_key
-                    }
-                    
-                    response = requests.get(self.here_parking_url, params=params, timeout=10)
-                    if response.status_code == 200:
-                        data = response.json()
-                        for item in data.get('items', []):
-                            spot_data = self._process_parking_spot(item, lat, lng)
-                            if spot_data and not self._is_duplicate(spot_data, all_spots):
-                                all_spots.append(spot_data)
+                    self._merge_spots(future.result(), lat, lng, all_spots, seen_keys)
                 except Exception:
                     continue
         
         # Sort by score and return top results
         all_spots.sort(key=lambda x: x.get('score', 0), reverse=True)
-        return all_spots[:10]  # Return top 10
+        top_spots = all_spots[:10]  # Return top 10
+        
+        if top_spots:
+            self.parking_cache.set(cache_key, top_spots)
+        return list(top_spots)
+
+    def _fetch_parking(self, extra_params: Dict, lat: float, lng: float, timeout: int) -> List[Dict]:
+        """Run a single HERE discover query and return its raw items"""
+        params = {
+            'at': f"{lat},{lng}",
+            'apikey': self.here_api_key,
+            **extra_params
+        }
+        
+        response = self.session.get(self.here_parking_url, params=params, timeout=timeout)
+        response.raise_for_status()
+        
+        return orjson.loads(response.content).get('items', [])
 
-    def _process_parking_spot(self, spot: Dict, user_lat: float, user_lng: float) -> Optional[Dict]:
+    def _merge_spots(self, items: List[Dict], lat: float, lng: float, all_spots: List[Dict], seen_keys: set) -> None:
+        """Process raw HERE items and append the new, non-duplicate spots"""
+        distances = self._calculate_distances(lat, lng, items)
+        for item, distance in zip(items, distances):
+            if distance is None:
+                continue
+            spot_data = self._process_parking_spot(item, distance)
+            if not spot_data:
+                continue
+            key = self._spot_key(spot_data)
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+            all_spots.append(spot_data)
+
+    def _process_parking_spot(self, spot: Dict, distance: int) -> Optional[Dict]:
         """Process and enhance parking spot data"""
         try:
-            spot_lat = spot.get('position', {}).get('lat', 0)
-            spot_lng = spot.get('position', {}).get('lng', 0)
-            distance = self._calculate_distance(user_lat, user_lng, spot_lat, spot_lng)
-            
             # Skip if too far or invalid
             if distance > 3000 or not spot.get('title'):
                 return None
@@ -156,19 +404,19 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             
             # Skip non-parking related results
             title_lower = title.lower()
-            if not any(term in title_lower for term in ['park', 'garage', 'car', 'space', 'charging']):
+            if not PARKING_TITLE_RE.search(title_lower):
                 return None
             
             # Determine parking type
             parking_type = 'parking-lot'
-            if any(term in title_lower for term in ['garage', 'multi', 'story']):
-                parking_type = 'parking-garage'
-            elif any(term in title_lower for term in ['street', 'road', 'meter']):
-                parking_type = 'on-street-parking'
-            elif any(term in title_lower for term in ['electric', 'ev', 'charging']):
-                parking_type = 'ev-charging'
+            tokens = set(TITLE_TOKEN_RE.findall(title_lower))
+            for candidate_type, terms in TYPE_MAP:
+                if tokens & terms:
+                    parking_type = candidate_type
+                    break
             
             walking_time = max(1, distance // 80)  # 80m per minute
+            distance_bucket = distance // 100  # 100m buckets keep the helper caches small
             
             spot_data = {
                 'name': title,
@@ -177,10 +425,10 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
                 'walking_time': walking_time,
                 'position': spot.get('position', {}),
                 'parking_type': parking_type,
-                'pricing': self._estimate_pricing(parking_type, distance),
-                'availability': self._estimate_availability(parking_type),
-                'features': self._get_features(parking_type, distance),
-                'score': self._calculate_score(distance, parking_type),
+                'pricing': dict(self._estimate_pricing(parking_type, distance_bucket)),
+                'availability': self._estimate_availability(parking_type, datetime.datetime.now().hour),
+                'features': list(self._get_features(parking_type, distance_bucket)),
+                'score': self._calculate_score(distance_bucket, parking_type),
                 'contacts': spot.get('contacts', [])
             }
             
@@ -190,28 +438,25 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             print(f"Error processing spot: {e}")
             return None
 
-    def _is_duplicate(self, new_spot: Dict, existing_spots: List[Dict]) -> bool:
-        """Check if parking spot is duplicate based on location"""
-        new_pos = new_spot.get('position', {})
-        new_key = f"{new_pos.get('lat', 0):.4f},{new_pos.get('lng', 0):.4f}"
-        
-        for spot in existing_spots:
-            pos = spot.get('position', {})
-            key = f"{pos.get('lat', 0):.4f},{pos.get('lng', 0):.4f}"
-            if key == new_key:
-                return True
-        return False
+    @staticmethod
+    def _spot_key(spot: Dict) -> str:
+        """Location key used to de-duplicate parking spots (~11m precision)"""
+        pos = spot.get('position', {})
+        return f"{pos.get('lat', 0):.4f},{pos.get('lng', 0):.4f}"
 
-    def _estimate_pricing(self, parking_type: str, distance: int) -> Dict:
+    # Estimators are pure functions of their arguments, so results are memoized
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _estimate_pricing(parking_type: str, distance_bucket: int) -> Dict:
         """Estimate realistic UK parking pricing"""
         if parking_type == 'parking-garage':
-            base_rate = 4.00 if distance < 500 else 3.20
+            base_rate = 4.00 if distance_bucket < 5 else 3.20
         elif parking_type == 'on-street-parking':
-            base_rate = 3.00 if distance < 500 else 2.40
+            base_rate = 3.00 if distance_bucket < 5 else 2.40
         elif parking_type == 'ev-charging':
             base_rate = 2.80
         else:
-            base_rate = 2.60 if distance < 500 else 2.00
+            base_rate = 2.60 if distance_bucket < 5 else 2.00
         
         return {
             'hourly_rate': f"£{base_rate:.2f}",
@@ -219,10 +464,10 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             'estimated': True
         }
 
-    def _estimate_availability(self, parking_type: str) -> str:
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _estimate_availability(parking_type: str, current_hour: int) -> str:
         """Estimate availability based on time and type"""
-        current_hour = datetime.datetime.now().hour
-        
         if 8 <= current_hour <= 18:
             if parking_type == 'on-street-parking':
                 return 'Limited'
@@ -231,7 +476,9 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
         else:
             return 'Excellent'
 
-    def _get_features(self, parking_type: str, distance: int) -> List[str]:
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _get_features(parking_type: str, distance_bucket: int) -> List[str]:
         """Get parking spot features"""
         features = []
         
@@ -242,23 +489,25 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
         elif parking_type == 'on-street-parking':
             features.append('Street Parking')
         
-        if distance < 200:
+        if distance_bucket < 2:
             features.append('Very Close')
-        elif distance < 500:
+        elif distance_bucket < 5:
             features.append('Walking Distance')
             
         return features
 
-    def _calculate_score(self, distance: int, parking_type: str) -> int:
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _calculate_score(distance_bucket: int, parking_type: str) -> int:
         """Calculate recommendation score for sorting"""
         score = 50
         
         # Distance scoring
-        if distance < 200:
+        if distance_bucket < 2:
             score += 25
-        elif distance < 500:
+        elif distance_bucket < 5:
             score += 20
-        elif distance < 1000:
+        elif distance_bucket < 10:
             score += 15
         
         # Type bonus
@@ -273,12 +522,22 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
         """Generate mock data when API returns insufficient results"""
         city = location_info.get('city', 'the area')
         
+        cached = self.mock_cache.get(city)
+        if cached is None:
+            cached = self._build_mock_spots(city)
+            self.mock_cache.set(city, cached)
+        return [dict(spot) for spot in cached]
+
+    def _build_mock_spots(self, city: str) -> List[Dict]:
+        # Seeded by city so every worker and restart shows the same numbers
+        rng = random.Random(city)
+        
         mock_spots = [
             {
                 'name': f'{city} Multi-Story Car Park',
                 'address': f'High Street, {city}',
-                'distance': random.randint(80, 300),
-                'walking_time': random.randint(2, 4),
+                'distance': rng.randint(80, 300),
+                'walking_time': rng.randint(2, 4),
                 'parking_type': 'parking-garage',
                 'pricing': {'hourly_rate': '£3.50', 'daily_rate': '£18.00'},
                 'availability': 'Good',
@@ -288,8 +547,8 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             {
                 'name': f'{city} Pay & Display Zone',
                 'address': f'Market Street, {city}',
-                'distance': random.randint(50, 250),
-                'walking_time': random.randint(1, 3),
+                'distance': rng.randint(50, 250),
+                'walking_time': rng.randint(1, 3),
                 'parking_type': 'on-street-parking',
                 'pricing': {'hourly_rate': '£2.80', 'daily_rate': 'Max 4 hours'},
                 'availability': 'Limited',
@@ -299,8 +558,8 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             {
                 'name': f'{city} Shopping Centre Car Park',
                 'address': f'Retail Park, {city}',
-                'distance': random.randint(150, 400),
-                'walking_time': random.randint(3, 6),
+                'distance': rng.randint(150, 400),
+                'walking_time': rng.randint(3, 6),
                 'parking_type': 'parking-lot',
                 'pricing': {'hourly_rate': '£2.20', 'daily_rate': '£12.00'},
                 'availability': 'Excellent',
@@ -310,8 +569,8 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             {
                 'name': f'{city} Council Car Park',
                 'address': f'Town Centre, {city}',
-                'distance': random.randint(200, 450),
-                'walking_time': random.randint(3, 6),
+                'distance': rng.randint(200, 450),
+                'walking_time': rng.randint(3, 6),
                 'parking_type': 'parking-lot',
                 'pricing': {'hourly_rate': '£1.80', 'daily_rate': '£10.00'},
                 'availability': 'Good',
@@ -322,24 +581,33 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
         
         return mock_spots
 
-    def _calculate_distance(self, lat1: float, lng1: float, lat2: float, lng2: float) -> int:
-        """Calculate distance between two points in meters"""
-        from math import radians, cos, sin, asin, sqrt
-        
-        lat1, lng1, lat2, lng2 = map(radians, [lat1, lng1, lat2, lng2])
-        
-        dlat = lat2 - lat1
-        dlng = lng2 - lng1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlng/2)**2
-        c = 2 * asin(sqrt(a))
+    def _calculate_distances(self, user_lat: float, user_lng: float, items: List[Dict]) -> List[Optional[int]]:
+        """Calculate distance in meters from the user to every item in one pass (None for bad items)"""
         r = 6371000  # Radius of earth in meters
+        lat1 = radians(user_lat)
+        lng1 = radians(user_lng)
+        cos_lat1 = cos(lat1)
         
-        return int(c * r)
+        distances = []
+        for item in items:
+            try:
+                position = item.get('position') or {}
+                lat2 = radians(position.get('lat') or 0)
+                lng2 = radians(position.get('lng') or 0)
+                
+                dlat = lat2 - lat1
+                dlng = lng2 - lng1
+                a = sin(dlat/2)**2 + cos_lat1 * cos(lat2) * sin(dlng/2)**2
+                distances.append(int(2 * asin(sqrt(a)) * r))
+            except Exception as e:
+                print(f"Error calculating distance: {e}")
+                distances.append(None)
+        
+        return distances
 
     def handle_follow_up_question(self, user_message: str, session_id: str) -> Optional[str]:
         """Handle follow-up questions about previous searches"""
-        session_data = self.conversations.get(session_id, {})
-        last_parking_data = session_data.get('last_parking_search')
+        last_parking_data = self.sessions.get_last_search(session_id)
         
         if not last_parking_data:
             return None
@@ -353,210 +621,296 @@ Remember: You're Parksy, the parking assistant people actually want to talk to.
             cheapest = min(spots, key=lambda x: float(x.get('pricing', {}).get('hourly_rate', '£99').replace('£', '')))
             closest = min(spots, key=lambda x: x.get('walking_time', 99))
             
-            response = f"Based on your {location} search, here are my top picks:\n\n"
-            response += f"🏆 **Overall Best:** {top_spot['name']}\n"
-            response += f"   Best balance of location, price, and features\n\n"
-            response += f"💰 **Cheapest:** {cheapest['name']}\n"
-            response += f"   Just {cheapest['pricing']['hourly_rate']}/hour\n\n"
-            response += f"🚶 **Closest:** {closest['name']}\n"
-            response += f"   Only {closest['walking_time']} min walk\n\n"
-            response += "What matters most to you - price, convenience, or security?"
-            
-            return response
+            return (
+                f"Based on your {location} search, here are my top picks:\n\n"
+                f"🏆 **Overall Best:** {top_spot['name']}\n"
+                f"   Best balance of location, price, and features\n\n"
+                f"💰 **Cheapest:** {cheapest['name']}\n"
+                f"   Just {cheapest['pricing']['hourly_rate']}/hour\n\n"
+                f"🚶 **Closest:** {closest['name']}\n"
+                f"   Only {closest['walking_time']} min walk\n\n"
+                "What matters most to you - price, convenience, or security?"
+            )
         
         return None
 
-    def generate_ai_response(self, user_input: str, parking_data: List[Dict], location_info: Dict, session_id: str) -> str:
-        """Generate AI response using DeepSeek R1 via OpenRouter"""
-        try:
-            # Get conversation history for this session
-            session_data = self.conversations.get(session_id, {})
-            conversation_history = session_data.get('history', [])
-            
-            # Build conversation context
-            conversation_context = ""
-            if conversation_history:
-                conversation_context = "Previous conversation:\n"
-                for entry in conversation_history[-3:]:
-                    conversation_context += f"User: {entry['user']}\nParksy: {entry['assistant']}\n"
-                conversation_context += "\n"
-
-            # Prepare context with parking data
-            context = f"""
+    def _openrouter_headers(self) -> Dict:
+        return {
+            "Authorization": f"Bearer {self.openrouter_api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def _build_parking_payload(self, user_input: str, parking_data: List[Dict], location_info: Dict, session_id: str) -> Dict:
+        """Build the OpenRouter request for a parking search answer"""
+        # Get conversation history for this session
+        conversation_history = self.sessions.get_history(session_id)
+        
+        # Build conversation context
+        conversation_context = ""
+        if conversation_history:
+            conversation_context = "".join([
+                "Previous conversation:\n",
+                *[f"User: {entry['user']}\nParksy: {entry['assistant']}\n" for entry in conversation_history[-3:]],
+                "\n"
+            ])
+
+        # Prepare context with parking data
+        context = f"""
 {conversation_context}Current query: {user_input}
 
 Location searched: {location_info.get('address', 'Unknown location') if location_info else 'No specific location'}
 Current time: {datetime.datetime.now().strftime('%A, %B %d, %Y at %I:%M %p')}
 
 """
-            
-            if parking_data:
-                context += f"Found {len(parking_data)} parking options:\n\n"
-                for i, spot in enumerate(parking_data, 1):
-                    walking_text = f"{spot['walking_time']} min walk"
-                    context += f"{i}. {spot['name']}\n"
-                    context += f"   📍 {spot['address']}\n"
-                    context += f"   🚶 {walking_text} • 💰 {spot['pricing']['hourly_rate']}/hour\n"
-                    
-                    if spot.get('features'):
-                        context += f"   ✨ {', '.join(spot['features'][:3])}\n"
-                    
-                    context += f"   Availability: {spot['availability']}\n\n"
-            else:
-                context += "No parking spots found in the searched area.\n"
+        
+        parts = [context]
+        if parking_data:
+            parts.append(f"Found {len(parking_data)} parking options:\n\n")
+            for i, spot in enumerate(parking_data, 1):
+                parts.append(
+                    f"{i}. {spot['name']}\n"
+                    f"   📍 {spot['address']}\n"
+                    f"   🚶 {spot['walking_time']} min walk • 💰 {spot['pricing']['hourly_rate']}/hour\n"
+                )
+                if spot.get('features'):
+                    parts.append(f"   ✨ {', '.join(spot['features'][:3])}\n")
+                parts.append(f"   Availability: {spot['availability']}\n\n")
+        else:
+            parts.append("No parking spots found in the searched area.\n")
+        context = "".join(parts)
 
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": context}
-            ]
-            
-            headers = {
-                "Authorization": f"Bearer {self.openrouter_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "model": "deepseek/deepseek-r1",
-                "messages": messages,
-                "temperature": 0.8,
-                "max_tokens": 1500,
-                "top_p": 0.9
-            }
-            
-            response = requests.post(self.openrouter_url, headers=headers, json=payload, timeout=30)
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": context}
+        ]
+        
+        return {
+            "model": "deepseek/deepseek-r1",
+            "messages": messages,
+            "temperature": 0.8,
+            "max_tokens": 1500,
+            "top_p": 0.9
+        }
+
+    def _build_chat_payload(self, user_input: str, session_id: str) -> Dict:
+        """Build the OpenRouter request for general (non-search) conversation"""
+        conversation_history = self.sessions.get_history(session_id)
+        
+        conversation_context = ""
+        if conversation_history:
+            conversation_context = "".join([
+                "Previous conversation:\n",
+                *[f"User: {entry['user']}\nParksy: {entry['assistant']}\n" for entry in conversation_history[-2:]]
+            ])
+
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": f"{conversation_context}\nUser just said: {user_input}\n\nRespond naturally as Parksy. If it's not parking-related, gently guide toward how you can help with parking."}
+        ]
+        
+        return {
+            "model": "deepseek/deepseek-r1:free",
+            "messages": messages,
+            "temperature": 0.8,
+            "max_tokens": 600
+        }
+
+    def _parking_fallback(self, parking_data: List[Dict]) -> str:
+        """Plain response listing the parking data when the AI returns nothing"""
+        if parking_data:
+            parts = [f"I found {len(parking_data)} great parking options for you!\n\n"]
+            for i, spot in enumerate(parking_data[:5], 1):
+                parts.append(
+                    f"🅿️ **{i}. {spot['name']}**\n"
+                    f"📍 {spot['address']}\n"
+                    f"🚶 {spot['walking_time']} min walk • 💰 {spot['pricing']['hourly_rate']}/hour\n"
+                )
+                if spot.get('features'):
+                    parts.append(f"✨ {', '.join(spot['features'][:2])}\n")
+                parts.append("\n")
+            return "".join(parts)
+        
+        return "I'm having trouble with my response system, but I'm here to help with parking!"
+
+    def complete_ai_response(self, payload: Dict) -> Optional[str]:
+        """Run a blocking OpenRouter completion; None when the response has no choices"""
+        response = self.session.post(self.openrouter_url, headers=self._openrouter_headers(), data=orjson.dumps(payload), timeout=30)
+        response.raise_for_status()
+        
+        data = orjson.loads(response.content)
+        if 'choices' in data and data['choices']:
+            return data['choices'][0]['message']['content']
+        return None
+
+    def _ai_error_response(self, parking_data: List[Dict]) -> str:
+        """Response when the OpenRouter call itself fails"""
+        if parking_data:
+            return f"I found {len(parking_data)} parking options for you! The search worked but I'm having response issues. Try asking 'which is best?' for recommendations."
+        return "I'm having some technical difficulties right now. Could you try asking again?"
+
+    def stream_ai_response(self, payload: Dict) -> Iterator[str]:
+        """Stream an OpenRouter completion, yielding content deltas as they arrive"""
+        response = self.session.post(
+            self.openrouter_url,
+            headers=self._openrouter_headers(),
+            data=orjson.dumps({**payload, "stream": True}),
+            timeout=30,
+            stream=True
+        )
+        with response:
             response.raise_for_status()
             
-            data = response.json()
-            if 'choices' in data and data['choices']:
-                return data['choices'][0]['message']['content']
-            
-            # Fallback response with parking data
-            if parking_data:
-                fallback = f"I found {len(parking_data)} great parking options for you!\n\n"
-                for i, spot in enumerate(parking_data[:5], 1):
-                    fallback += f"🅿️ **{i}. {spot['name']}**\n"
-                    fallback += f"📍 {spot['address']}\n"
-                    fallback += f"🚶 {spot['walking_time']} min walk • 💰 {spot['pricing']['hourly_rate']}/hour\n"
-                    if spot.get('features'):
-                        fallback += f"✨ {', '.join(spot['features'][:2])}\n"
-                    fallback += "\n"
-                return fallback
-            
-            return "I'm having trouble with my response system, but I'm here to help with parking!"
-            
-        except Exception as e:
-            print(f"AI response error: {e}")
-            if parking_data:
-                return f"I found {len(parking_data)} parking options for you! The search worked but I'm having response issues. Try asking 'which is best?' for recommendations."
-            return "I'm having some technical difficulties right now. Could you try asking again?"
+            for line in response.iter_lines():
+                # Skip keep-alive comments (": OPENROUTER PROCESSING") and blank lines
+                if not line.startswith(b'data: '):
+                    continue
+                data = line[len(b'data: '):]
+                if data == b'[DONE]':
+                    break
+                
+                choices = orjson.loads(data).get('choices')
+                if choices:
+                    content = (choices[0].get('delta') or {}).get('content')
+                    if content:
+                        yield content
 
     def extract_location_from_query(self, user_input: str) -> Optional[str]:
         """Extract location from user query using improved patterns"""
-        patterns = [
-            r"(?:at|near|in|around|by|close to|next to)\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
-            r"park\s+(?:at|near|in|around|by|close to|next to)\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
-            r"parking\s+(?:at|near|in|around|by|close to|next to)\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
-            r"(?:where|how|can)\s+.*?(?:at|near|in|around|by)\s+([^?.,!]+?)(?:\s*[?.,!]|$)",
-            r"going\s+to\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
-            r"visiting\s+([^?.,!]+?)(?:\s+(?:at|for|during)|\s*[?.,!]|$)",
-            r"spots?\s+(?:in|at|near)\s+([^?.,!]+?)(?:\s*[?.,!]|$)",
-            r"spaces?\s+(?:in|at|near)\s+([^?.,!]+?)(?:\s*[?.,!]|$)"
-        ]
+        return extract_location(user_input)
+
+    def _find_parking(self, location: str) -> Optional[Tuple[Dict, List[Dict]]]:
+        """Geocode a location and collect up to 10 parking spots around it.
         
-        for pattern in patterns:
-            match = re.search(pattern, user_input, re.IGNORECASE)
-            if match:
-                location = match.group(1).strip()
-                if location.lower() not in ['there', 'here', 'it', 'this', 'that', 'a', 'the']:
-                    return location
+        Concurrent calls for the same location wait on the first caller's result
+        instead of repeating the HERE requests.
+        """
+        key = ' '.join(location.lower().split())
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
         
-        return None
+        if not owner:
+            found = future.result()
+            return (found[0], list(found[1])) if found else None
+        
+        try:
+            found = self._lookup_parking(location)
+            future.set_result(found)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+        
+        return (found[0], list(found[1])) if found else None
 
-    def process_query(self, user_input: str, session_id: str = "default") -> str:
-        """Process user query and return response"""
-        # Initialize session if needed
-        if session_id not in self.conversations:
-            self.conversations[session_id] = {'history': [], 'last_parking_search': None}
+    def _lookup_parking(self, location: str) -> Optional[Tuple[Dict, List[Dict]]]:
+        # Geocode the location
+        location_info = self.geocode_location(location)
+        if not location_info:
+            return None
         
+        # Search for parking
+        parking_data = self.search_parking(location_info['lat'], location_info['lng'])
+        
+        # Add mock data if insufficient results
+        if len(parking_data) < 5:
+            mock_data = self.generate_mock_data(location_info)
+            parking_data.extend(mock_data)
+            parking_data = parking_data[:10]  # Limit to 10
+        
+        return location_info, parking_data
+
+    def _location_not_found(self, location: str) -> str:
+        return f"Hmm, I'm having trouble finding '{location}'. Could you be a bit more specific? Maybe include a street address or a well-known landmark?"
+
+    def _prepare_query(self, user_input: str, session_id: str) -> Tuple[Optional[str], Optional[Dict], Optional[List[Dict]]]:
+        """Shared front half of process_query and process_query_stream.
+        
+        Returns (reply, None, None) when the query is answered without the AI, otherwise
+        (None, payload, parking_data) with parking_data None for general conversation.
+        """
         # Check for follow-up questions first
         follow_up = self.handle_follow_up_question(user_input, session_id)
         if follow_up:
-            self.conversations[session_id]['history'].append({'user': user_input, 'assistant': follow_up})
-            return follow_up
+            self.sessions.add_history(session_id, user_input, follow_up)
+            return follow_up, None, None
         
         # Extract location for specific searches
         location = self.extract_location_from_query(user_input)
         
-        if location:
-            # Geocode the location
-            location_info = self.geocode_location(location)
-            if not location_info:
-                response = f"Hmm, I'm having trouble finding '{location}'. Could you be a bit more specific? Maybe include a street address or a well-known landmark?"
-                self.conversations[session_id]['history'].append({'user': user_input, 'assistant': response})
-                return response
-            
-            # Search for parking
-            parking_data = self.search_parking(location_info['lat'], location_info['lng'])
-            
-            # Add mock data if insufficient results
-            if len(parking_data) < 5:
-                mock_data = self.generate_mock_data(location_info)
-                parking_data.extend(mock_data)
-                parking_data = parking_data[:10]  # Limit to 10
-            
-            # Store parking data for follow-up questions
-            self.conversations[session_id]['last_parking_search'] = {
-                'spots': parking_data,
-                'location': location_info.get('city', location)
-            }
-            
-            # Generate AI response
-            ai_response = self.generate_ai_response(user_input, parking_data, location_info, session_id)
-            self.conversations[session_id]['history'].append({'user': user_input, 'assistant': ai_response})
-            return ai_response
-        
-        else:
+        if not location:
             # Handle general conversation
-            try:
-                session_data = self.conversations[session_id]
-                conversation_history = session_data.get('history', [])
-                
-                conversation_context = ""
-                if conversation_history:
-                    conversation_context = "Previous conversation:\n"
-                    for entry in conversation_history[-2:]:
-                        conversation_context += f"User: {entry['user']}\nParksy: {entry['assistant']}\n"
-
-                messages = [
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": f"{conversation_context}\nUser just said: {user_input}\n\nRespond naturally as Parksy. If it's not parking-related, gently guide toward how you can help with parking."}
-                ]
-                
-                headers = {
-                    "Authorization": f"Bearer {self.openrouter_api_key}",
-                    "Content-Type": "application/json"
-                }
-                
-                payload = {
-                    "model": "deepseek/deepseek-r1:free",
-                    "messages": messages,
-                    "temperature": 0.8,
-                    "max_tokens": 600
-                }
-                
-                response = requests.post(self.openrouter_url, headers=headers, json=payload, timeout=30)
-                response.raise_for_status()
-                
-                data = response.json()
-                if 'choices' in data and data['choices']:
-                    ai_response = data['choices'][0]['message']['content']
-                    self.conversations[session_id]['history'].append({'user': user_input, 'assistant': ai_response})
-                    return ai_response
-                    
-            except Exception as e:
-                print(f"Chat error: {e}")
-                
-            return "Hey! I'm Parksy, your parking assistant. What can I help you find today?"
+            return None, self._build_chat_payload(user_input, session_id), None
+        
+        found = self._find_parking(location)
+        if not found:
+            response = self._location_not_found(location)
+            self.sessions.add_history(session_id, user_input, response)
+            return response, None, None
+        location_info, parking_data = found
+        
+        # Store parking data for follow-up questions
+        self.sessions.set_last_search(session_id, {
+            'spots': parking_data,
+            'location': location_info.get('city', location)
+        })
+        
+        return None, self._build_parking_payload(user_input, parking_data, location_info, session_id), parking_data
+
+    def _finish_query(self, user_input: str, session_id: str, content: Optional[str], failed: bool, parking_data: Optional[List[Dict]]) -> str:
+        """Shared back half: pick the final response after the AI call and record history"""
+        if content:
+            self.sessions.add_history(session_id, user_input, content)
+            return content
+        
+        if parking_data is not None:
+            response = self._ai_error_response(parking_data) if failed else self._parking_fallback(parking_data)
+            self.sessions.add_history(session_id, user_input, response)
+            return response
+        
+        return "Hey! I'm Parksy, your parking assistant. What can I help you find today?"
+
+    def process_query(self, user_input: str, session_id: str = "default") -> str:
+        """Process user query and return response"""
+        reply, payload, parking_data = self._prepare_query(user_input, session_id)
+        if reply is not None:
+            return reply
+        
+        content = None
+        failed = False
+        try:
+            content = self.complete_ai_response(payload)
+        except Exception as e:
+            print(f"AI response error: {e}")
+            failed = True
+        
+        return self._finish_query(user_input, session_id, content, failed, parking_data)
+
+    def process_query_stream(self, user_input: str, session_id: str = "default") -> Iterator[str]:
+        """Process user query, yielding the response in chunks as the AI generates it"""
+        reply, payload, parking_data = self._prepare_query(user_input, session_id)
+        if reply is not None:
+            yield reply
+            return
+        
+        chunks = []
+        failed = False
+        try:
+            for chunk in self.stream_ai_response(payload):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"AI stream error: {e}")
+            failed = True
+        
+        response = self._finish_query(user_input, session_id, ''.join(chunks), failed, parking_data)
+        if not chunks:
+            yield response
 
 # Initialize Parksy
 parksy = Parksy()
@@ -648,11 +1002,39 @@ def chat():
     except Exception as e:
         return jsonify({'error': f'An error occurred: {str(e)}'}), 500
 
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream chat responses as server-sent events"""
+    try:
+        data = request.get_json()
+        user_message = data.get('message', '').strip()
+        session_id = data.get('session_id', 'web_session')
+        
+        if not user_message:
+            return jsonify({'error': 'No message provided'}), 400
+        
+        # Run up to the first chunk here so lookup errors still get a JSON error response
+        chunks = parksy.process_query_stream(user_message, session_id)
+        first_chunk = next(chunks, None)
+        
+    except Exception as e:
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+    
+    def events():
+        if first_chunk is not None:
+            yield f"data: {orjson.dumps({'delta': first_chunk}).decode()}\n\n"
+        for chunk in chunks:
+            yield f"data: {orjson.dumps({'delta': chunk}).decode()}\n\n"
+        yield f"data: {orjson.dumps({'done': True, 'session_id': session_id}).decode()}\n\n"
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream')
+
 @app.route('/health')
 def health():
     """Health check endpoint for Render"""
     return jsonify({'status': 'healthy', 'service': 'Parksy AI'})
 
+# Local development only; production runs under gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
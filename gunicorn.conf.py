@@ -0,0 +1,13 @@
+# Gunicorn settings for serving Parksy in production: gunicorn app:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Threaded workers: requests mostly wait on HERE/OpenRouter, so threads give cheap concurrency
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# In-memory sessions are per process, so only scale out workers when Redis holds them
+default_workers = multiprocessing.cpu_count() if os.environ.get('REDIS_URL') else 1
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))